@@ -13,78 +13,280 @@ Version: 1.0.0 (Beta)
 Copyright (c) 2025 นายปองดี ไชยจันดา (Pongdee Chaichanda)
 """
 
+import atexit
+import hashlib
+import multiprocessing
 import os
+import queue
+import shutil
 import tempfile
+import threading
 import zipfile
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from flask import Flask, render_template, request, send_file, jsonify, after_this_request
+from flask import Flask, Response, render_template, request, send_file, jsonify
 from werkzeug.utils import secure_filename
-import pandas as pd
-from io import StringIO, BytesIO
+from zipstream import ZipStream
+from io import BytesIO, StringIO
+from convert_xls_to_csv import convert_to_csv_bytes, csv_rows, csv_writer
+
+
+def make_upload_folder(min_free_bytes):
+    """
+    สร้างโฟลเดอร์ชั่วคราวสำหรับไฟล์ที่อัปโหลด และลบทิ้งเมื่อโปรแกรมจบการทำงาน
+    ใช้ /dev/shm (tmpfs ในหน่วยความจำ) ถ้ามีพื้นที่ว่างพอ เพื่อให้การบันทึกไฟล์ชั่วคราวไม่ต้องเขียนลงดิสก์
+    (/dev/shm ใน container มักมีเพียง 64MB ถ้าไม่พอจะใช้โฟลเดอร์ชั่วคราวปกติของระบบ)
+    Returns: path ของโฟลเดอร์
+    """
+    shm_dir = '/dev/shm'
+    use_shm = os.path.isdir(shm_dir) and shutil.disk_usage(shm_dir).free >= min_free_bytes
+    upload_folder = tempfile.mkdtemp(dir=shm_dir if use_shm else None)
+    atexit.register(shutil.rmtree, upload_folder, ignore_errors=True)
+    return upload_folder
+
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max file size
-app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp()
+app.config['UPLOAD_FOLDER'] = None  # สร้างเมื่อมีการอัปโหลดครั้งแรก (ดู get_upload_folder)
+app.config['CSV_CACHE_MAX_BYTES'] = 64 * 1024 * 1024  # ขนาดรวมสูงสุดของ CSV ใน cache
+app.config['CSV_STREAM_CHUNK_SIZE'] = 64 * 1024  # ขนาดข้อมูลที่ส่งต่อครั้งเมื่อ stream CSV
+app.config['CSV_STREAM_CACHE_MAX_BYTES'] = 1024 * 1024  # CSV ที่ stream ขนาดไม่เกินนี้จึงเก็บลง cache
 
 ALLOWED_EXTENSIONS = {'xls', 'xlsx'}
 
+# cache ผลการแปลงไฟล์ (LRU): key = hash ของเนื้อหาไฟล์, value = bytes ของ CSV
+csv_cache = OrderedDict()
+csv_cache_size = 0
+csv_cache_lock = threading.Lock()
+
+# lock สำหรับสร้าง UPLOAD_FOLDER เพียงครั้งเดียว (ดู get_upload_folder)
+upload_folder_lock = threading.Lock()
+
+# process pool สำหรับแปลงไฟล์ใน ZIP (สร้างเมื่อใช้ครั้งแรกใน get_conversion_pool)
+conversion_pool = None
+conversion_pool_lock = threading.Lock()
+
+# คิวของไฟล์ชั่วคราวที่รอลบ (ลบใน background thread เพื่อไม่ให้เพิ่มเวลาตอบกลับ)
+cleanup_queue = queue.Queue()
+
 
 def allowed_file(filename):
     """ตรวจสอบว่าไฟล์ที่อัปโหลดเป็น .xls หรือ .xlsx"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def xls_to_csv_utf8(file_path):
+def remove_temp_files():
+    """ลบไฟล์ชั่วคราวที่ถูกส่งเข้า cleanup_queue (รันใน background thread)"""
+    for temp_path in iter(cleanup_queue.get, None):
+        try:
+            os.remove(temp_path)
+        except Exception:
+            pass
+
+
+threading.Thread(target=remove_temp_files, daemon=True).start()
+
+
+def file_digest(file_like):
     """
-    แปลงไฟล์ .xls เป็น CSV UTF-8
-    Returns: BytesIO object containing CSV data
+    คำนวณ hash (BLAKE2b) ของเนื้อหาไฟล์จาก file-like object เพื่อใช้เป็น key ของ cache
+    Returns: hex digest
     """
+    digest = hashlib.blake2b(digest_size=16)
+    file_like.seek(0)
+    for chunk in iter(lambda: file_like.read(1024 * 1024), b''):
+        digest.update(chunk)
+    file_like.seek(0)
+    return digest.hexdigest()
+
+
+def get_cached_csv(digest):
+    """ดึง CSV จาก cache (คืนค่า None ถ้าไม่มี)"""
+    with csv_cache_lock:
+        csv_bytes = csv_cache.get(digest)
+        if csv_bytes is not None:
+            csv_cache.move_to_end(digest)
+        return csv_bytes
+
+
+def cache_csv(digest, csv_bytes):
+    """เก็บ CSV ลง cache และลบรายการที่ใช้งานนานที่สุดออกเมื่อเกินขนาดที่กำหนด"""
+    global csv_cache_size
+    max_bytes = app.config['CSV_CACHE_MAX_BYTES']
+    if len(csv_bytes) > max_bytes:
+        return
+    
+    with csv_cache_lock:
+        if digest in csv_cache:
+            return
+        csv_cache[digest] = csv_bytes
+        csv_cache_size += len(csv_bytes)
+        while csv_cache_size > max_bytes:
+            _, old_bytes = csv_cache.popitem(last=False)
+            csv_cache_size -= len(old_bytes)
+
+
+def generate_csv_stream(rows, digest):
+    """
+    สร้าง CSV UTF-8 with BOM แบบ streaming ส่งออกทีละก้อนระหว่างที่อ่านแถว
+    ถ้าขนาดรวมไม่เกิน CSV_STREAM_CACHE_MAX_BYTES จะเก็บผลลัพธ์ลง cache เมื่อส่งครบ
+    (ไฟล์ที่ใหญ่กว่านั้นจะเลิกเก็บก้อนข้อมูลทันที หน่วยความจำจึงไม่โตตามขนาดไฟล์)
+    """
+    chunk_size = app.config['CSV_STREAM_CHUNK_SIZE']
+    max_cache_bytes = app.config['CSV_STREAM_CACHE_MAX_BYTES']
+    bom = b'\xef\xbb\xbf'
+    chunks = [bom]
+    total_size = len(bom)
+    
+    buffer = StringIO()
+    writer = csv_writer(buffer)
+    yield bom
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() < chunk_size:
+            continue
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        if chunks is not None:
+            chunks.append(data)
+            total_size += len(data)
+            if total_size > max_cache_bytes:
+                chunks = None
+        yield data
+    
+    data = buffer.getvalue().encode('utf-8')
+    if data:
+        yield data
+    
+    if chunks is not None and total_size + len(data) <= max_cache_bytes:
+        chunks.append(data)
+        cache_csv(digest, b''.join(chunks))
+
+
+def get_conversion_pool():
+    """
+    คืน process pool สำหรับแปลงไฟล์ที่ใช้ร่วมกันทุก request (สร้างเมื่อใช้ครั้งแรก)
+    ใช้ forkserver เพื่อไม่ให้ fork จาก process ที่มี thread อื่นทำงานอยู่ (เสี่ยง deadlock)
+    และโหลด convert_xls_to_csv ไว้ล่วงหน้าใน forkserver ให้ worker เริ่มทำงานได้เร็ว
+    """
+    global conversion_pool
+    with conversion_pool_lock:
+        if conversion_pool is None:
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(['convert_xls_to_csv'])
+            else:
+                # Windows รองรับเฉพาะ spawn
+                context = multiprocessing.get_context('spawn')
+            conversion_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=context)
+            atexit.register(conversion_pool.shutdown, cancel_futures=True)
+        return conversion_pool
+
+
+def submit_conversion(temp_path):
+    """
+    ส่งไฟล์ไปแปลงใน process pool
+    ถ้า pool ใช้ไม่ได้แล้ว (เช่น worker ถูก kill) จะสร้าง pool ใหม่แทน
+    Returns: Future ของ bytes ของ CSV
+    """
+    global conversion_pool
+    pool = get_conversion_pool()
     try:
-        # อ่านไฟล์ Excel โดยใช้ pandas
+        return pool.submit(convert_to_csv_bytes, temp_path)
+    except BrokenProcessPool:
+        with conversion_pool_lock:
+            if conversion_pool is pool:
+                conversion_pool = None
+        pool.shutdown(wait=False)
+        return get_conversion_pool().submit(convert_to_csv_bytes, temp_path)
+
+
+def release_conversions(futures, temp_files):
+    """ยกเลิกการแปลงที่ยังไม่เริ่ม และส่งไฟล์ชั่วคราวไปลบใน background thread"""
+    for future in list(futures):
+        future.cancel()
+    for temp_path in temp_files:
+        cleanup_queue.put(temp_path)
+
+
+def get_upload_folder():
+    """
+    คืนโฟลเดอร์ชั่วคราวสำหรับไฟล์ที่อัปโหลด (สร้างเมื่อใช้ครั้งแรก)
+    ไม่สร้างตอน import เพราะ worker ของ process pool อาจ import ไฟล์นี้ซ้ำ
+    และ worker จบการทำงานโดยไม่เรียก atexit ทำให้โฟลเดอร์ค้างอยู่
+    """
+    with upload_folder_lock:
+        if app.config['UPLOAD_FOLDER'] is None:
+            app.config['UPLOAD_FOLDER'] = make_upload_folder(app.config['MAX_CONTENT_LENGTH'])
+        return app.config['UPLOAD_FOLDER']
+
+
+def new_temp_path(filename):
+    """
+    สร้างไฟล์ชั่วคราวชื่อไม่ซ้ำใน UPLOAD_FOLDER สำหรับไฟล์ที่อัปโหลดแต่ละไฟล์
+    (ไฟล์ที่ชื่อเหมือนกัน หรือ request ที่ทำงานพร้อมกัน จะไม่เขียนทับกัน)
+    Returns: path ของไฟล์ชั่วคราว
+    """
+    fd, temp_path = tempfile.mkstemp(
+        dir=get_upload_folder(),
+        suffix=Path(secure_filename(filename)).suffix
+    )
+    os.close(fd)
+    return temp_path
+
+
+def unique_csv_names(files):
+    """
+    ตั้งชื่อไฟล์ CSV ใน ZIP ไม่ให้ซ้ำกัน ชื่อที่ซ้ำจะต่อท้ายด้วย (2), (3), ...
+    (เช่น ชื่อไฟล์ภาษาไทยที่ secure_filename แล้วเหลือเพียง xlsx เหมือนกัน)
+    Returns: list ของชื่อไฟล์ CSV เรียงตามลำดับไฟล์
+    """
+    csv_names = []
+    used_names = set()
+    for file in files:
+        csv_filename = Path(secure_filename(file.filename)).with_suffix('.csv').name
+        stem = Path(csv_filename).stem
+        index = 1
+        while csv_filename.lower() in used_names:
+            index += 1
+            csv_filename = f'{stem} ({index}).csv'
+        used_names.add(csv_filename.lower())
+        csv_names.append(csv_filename)
+    return csv_names
+
+
+def save_upload(file, temp_path):
+    """
+    คำนวณ hash และบันทึกไฟล์ที่อัปโหลดลงดิสก์ (รันใน thread pool)
+    Returns: (path ของไฟล์ที่บันทึก, hash ของเนื้อหาไฟล์)
+    """
+    digest = file_digest(file.stream)
+    file.save(temp_path)
+    return temp_path, digest
+
+
+def generate_zip_stream(futures):
+    """
+    สร้าง ZIP แบบ streaming ส่งไฟล์ CSV แต่ละไฟล์ทันทีที่แปลงเสร็จ
+    (การยกเลิกงานที่เหลือและลบไฟล์ชั่วคราวทำใน call_on_close ของ response
+    เพื่อให้ทำงานแม้ generator จะไม่ถูกเริ่มเลยก็ตาม)
+    """
+    # ใช้ระดับการบีบอัดต่ำสุด (1) ไฟล์ CSV ยังเล็กลงมาก แต่ใช้ CPU น้อยกว่าค่าเริ่มต้นหลายเท่า
+    zip_stream = ZipStream(compress_type=zipfile.ZIP_DEFLATED, compress_level=1)
+    for future in as_completed(futures):
+        csv_filename, digest = futures.pop(future)
         try:
-            # ลองอ่านเป็น Excel ก่อน
-            df = pd.read_excel(file_path, sheet_name=0, engine=None, header=0)
-        except Exception:
-            # ถ้าไม่ได้ ลองอ่านเป็น HTML (กรณีที่ไฟล์เป็น HTML ที่บันทึกเป็น .xls)
-            try:
-                with open(file_path, 'rb') as f:
-                    html_content = f.read()
-                
-                # ลอง decode ด้วย UTF-8 ก่อน
-                try:
-                    html_text = html_content.decode('utf-8')
-                except UnicodeDecodeError:
-                    # ลอง encoding อื่นๆ
-                    encodings = ['cp874', 'tis-620', 'iso-8859-11', 'windows-874']
-                    html_text = None
-                    for enc in encodings:
-                        try:
-                            html_text = html_content.decode(enc)
-                            break
-                        except UnicodeDecodeError:
-                            continue
-                    
-                    if html_text is None:
-                        html_text = html_content.decode('utf-8', errors='replace')
-                
-                html_io = StringIO(html_text)
-                dfs = pd.read_html(html_io, encoding='utf-8')
-                if dfs:
-                    df = dfs[0]
-                else:
-                    raise ValueError("ไม่พบตารางในไฟล์ HTML")
-            except Exception as e:
-                raise ValueError(f"ไม่สามารถอ่านไฟล์ได้: {str(e)}")
-        
-        # แปลงเป็น CSV UTF-8 with BOM
-        output = BytesIO()
-        csv_content = df.to_csv(index=False, header=True, encoding='utf-8-sig', sep=',')
-        output.write(csv_content.encode('utf-8-sig'))
-        output.seek(0)
-        return output
-    
-    except Exception as e:
-        raise Exception(f"เกิดข้อผิดพลาดในการแปลงไฟล์: {str(e)}")
+            csv_bytes = future.result()
+        except Exception as e:
+            # ข้ามไฟล์ที่มีปัญหา
+            continue
+        cache_csv(digest, csv_bytes)
+        zip_stream.add(csv_bytes, csv_filename)
+        yield from zip_stream.all_files()
+    yield from zip_stream.footer()
 
 
 @app.route('/')
@@ -115,66 +317,78 @@ def convert_file():
         file = valid_files[0]
         filename = secure_filename(file.filename)
         
-        # บันทึกไฟล์ชั่วคราว
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(temp_path)
+        csv_filename = Path(filename).with_suffix('.csv').name
         
         try:
-            csv_data = xls_to_csv_utf8(temp_path)
-            csv_filename = Path(filename).with_suffix('.csv').name
+            # ถ้าเคยแปลงไฟล์ที่เนื้อหาเหมือนกันแล้ว ส่งผลลัพธ์จาก cache ได้เลย
+            digest = file_digest(file.stream)
+            csv_bytes = get_cached_csv(digest)
+            if csv_bytes is not None:
+                return send_file(
+                    BytesIO(csv_bytes),
+                    mimetype='text/csv',
+                    as_attachment=True,
+                    download_name=csv_filename
+                )
             
-            @after_this_request
-            def remove_file(response):
-                try:
-                    os.remove(temp_path)
-                except Exception:
-                    pass
-                return response
-            
-            return send_file(
-                csv_data,
-                mimetype='text/csv',
-                as_attachment=True,
-                download_name=csv_filename
-            )
+            # อ่านไฟล์จาก stream ที่อัปโหลดโดยตรง ไม่ต้องบันทึกลงดิสก์ก่อน
+            rows = csv_rows(file.stream)
         except Exception as e:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            return jsonify({'error': str(e)}), 500
+            return jsonify({'error': f"เกิดข้อผิดพลาดในการแปลงไฟล์: {str(e)}"}), 500
+        
+        # ส่ง CSV กลับแบบ streaming ทยอยส่งระหว่างที่แปลง ไม่ต้องรอแปลงเสร็จทั้งไฟล์
+        return Response(
+            generate_csv_stream(rows, digest),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename={csv_filename}'}
+        )
     
     # ถ้ามีหลายไฟล์ สร้าง ZIP
     else:
-        zip_buffer = BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            temp_files = []
-            for file in valid_files:
-                filename = secure_filename(file.filename)
-                temp_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(temp_path)
-                temp_files.append(temp_path)
-                
+        temp_files = [new_temp_path(file.filename) for file in valid_files]
+        csv_names = dict(zip(temp_files, unique_csv_names(valid_files)))
+        
+        # บันทึกไฟล์ใน thread pool พร้อมกับแปลงไฟล์ที่บันทึกเสร็จแล้วแบบขนานหลาย process
+        # (ต้องบันทึกให้เสร็จภายใน request เพราะ stream ของไฟล์ที่อัปโหลดจะถูกปิดหลังจากนั้น)
+        max_workers = min(len(temp_files), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=max_workers) as io_executor:
+            save_futures = [
+                io_executor.submit(save_upload, file, temp_path)
+                for file, temp_path in zip(valid_files, temp_files)
+            ]
+            futures = {}
+            save_error = None
+            for save_future in as_completed(save_futures):
                 try:
-                    csv_data = xls_to_csv_utf8(temp_path)
-                    csv_filename = Path(filename).with_suffix('.csv').name
-                    zip_file.writestr(csv_filename, csv_data.read())
+                    temp_path, digest = save_future.result()
                 except Exception as e:
-                    # ข้ามไฟล์ที่มีปัญหา
+                    # บันทึกไฟล์ไม่สำเร็จ (เช่น พื้นที่เต็ม) ไม่ต้องส่งไฟล์ที่เหลือไปแปลงต่อ
+                    save_error = e
                     continue
-            
-            # ลบไฟล์ชั่วคราว
-            for temp_path in temp_files:
-                try:
-                    os.remove(temp_path)
-                except Exception:
-                    pass
+                if save_error is not None:
+                    continue
+                
+                # ไฟล์ที่อยู่ใน cache แล้วไม่ต้องส่งไปแปลงใหม่
+                csv_bytes = get_cached_csv(digest)
+                if csv_bytes is not None:
+                    future = Future()
+                    future.set_result(csv_bytes)
+                else:
+                    future = submit_conversion(temp_path)
+                futures[future] = (csv_names[temp_path], digest)
+        
+        if save_error is not None:
+            release_conversions(futures, temp_files)
+            return jsonify({'error': f"ไม่สามารถบันทึกไฟล์ที่อัปโหลดได้: {str(save_error)}"}), 500
         
-        zip_buffer.seek(0)
-        return send_file(
-            zip_buffer,
+        # ส่ง ZIP กลับแบบ streaming ไม่ต้องเก็บ ZIP ทั้งไฟล์ไว้ในหน่วยความจำ
+        response = Response(
+            generate_zip_stream(futures),
             mimetype='application/zip',
-            as_attachment=True,
-            download_name='converted_files.zip'
+            headers={'Content-Disposition': 'attachment; filename=converted_files.zip'}
         )
+        response.call_on_close(lambda: release_conversions(futures, temp_files))
+        return response
 
 
 if __name__ == '__main__':
@@ -13,11 +13,249 @@ Version: 1.0.0 (Beta)
 Copyright (c) 2025 นายปองดี ไชยจันดา (Pongdee Chaichanda)
 """
 
+import csv
+import mmap
 import os
+import re
 import sys
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO, TextIOWrapper
+import lxml.html
+from python_calamine import CalamineWorkbook
 from pathlib import Path
-from io import StringIO
+
+# signature ของไฟล์ (magic bytes) สำหรับตรวจสอบประเภทไฟล์จริง
+OLE2_SIGNATURE = b'\xd0\xcf\x11\xe0'  # .xls (Excel 97-2003)
+ZIP_SIGNATURE = b'PK\x03\x04'  # .xlsx, .xlsb
+
+# encoding ภาษาไทยที่ลองตามลำดับเมื่อไฟล์ HTML ไม่ใช่ UTF-8
+THAI_ENCODINGS = ['cp874', 'tis-620', 'iso-8859-11']
+
+# ช่องว่างที่ยุบเป็นช่องว่างเดียวในเซลล์ HTML (แบบเดียวกับ pandas.read_html)
+HTML_WHITESPACE_RE = re.compile(r'[\r\n]+|\s{2,}')
+
+
+def sniff_file_type(file_like):
+    """
+    ตรวจสอบประเภทไฟล์จริงจาก 8 bytes แรก
+    
+    Args:
+        file_like: path ของไฟล์ หรือ file-like object (เช่น file.stream ของไฟล์ที่อัปโหลด)
+    
+    Returns:
+        'xls', 'xlsx' หรือ 'html'
+    """
+    if hasattr(file_like, 'read'):
+        file_like.seek(0)
+        header = file_like.read(8)
+        file_like.seek(0)
+    else:
+        with open(file_like, 'rb') as f:
+            header = f.read(8)
+    
+    if header.startswith(OLE2_SIGNATURE):
+        return 'xls'
+    if header.startswith(ZIP_SIGNATURE):
+        return 'xlsx'
+    # ไฟล์อื่นๆ ถือว่าเป็น HTML ที่บันทึกเป็น .xls
+    return 'html'
+
+
+def decode_html(html_content):
+    """
+    decode ข้อมูล HTML (bytes หรือ mmap) เป็นข้อความ
+    Returns: str
+    """
+    # ลอง decode ด้วย UTF-8 ก่อน (อ่านจาก buffer โดยตรง ไม่ต้องคัดลอกเป็น bytes)
+    try:
+        return str(html_content, 'utf-8')
+    except UnicodeDecodeError:
+        pass
+    
+    # ถ้า UTF-8 ไม่ได้ ลอง encoding ภาษาไทยอื่นๆ
+    for enc in THAI_ENCODINGS:
+        try:
+            return str(html_content, enc)
+        except UnicodeDecodeError:
+            continue
+    
+    # ถ้ายังไม่ได้ ให้ใช้ errors='replace'
+    return str(html_content, 'utf-8', errors='replace')
+
+
+def read_html_text(file_like):
+    """
+    อ่านไฟล์ HTML เป็นข้อความ
+    ไฟล์บนดิสก์ใช้ mmap เพื่อไม่ต้องคัดลอกเนื้อหาทั้งไฟล์ขึ้นหน่วยความจำก่อน decode
+    """
+    if hasattr(file_like, 'read'):
+        file_like.seek(0)
+        return decode_html(file_like.read())
+    with open(file_like, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as html_content:
+        return decode_html(html_content)
+
+
+def html_cell_span(cell, attr):
+    """อ่านค่า colspan/rowspan ของเซลล์ (ค่าที่ไม่ถูกต้องถือว่าเป็น 1)"""
+    try:
+        return max(int(cell.get(attr, 1)), 1)
+    except ValueError:
+        return 1
+
+
+def fill_rowspan_cells(row, pending):
+    """เติมเซลล์ที่ถูก rowspan จากแถวก่อนหน้าครอบไว้ ณ ตำแหน่งปัจจุบันของแถว"""
+    while len(row) in pending:
+        col = len(row)
+        row.append(pending[col][1])
+        pending[col][0] -= 1
+        if pending[col][0] == 0:
+            del pending[col]
+
+
+def drop_hidden_elements(tree):
+    """
+    ลบแท็ก <style> และ element ที่ซ่อนด้วย style="display:none" ออกจาก tree
+    (แบบเดียวกับ pandas.read_html(displayed_only=True))
+    """
+    for element in tree.xpath('//style|//*[@style]'):
+        if element.tag != 'style' and 'display:none' not in ''.join(element.get('style').split()).lower():
+            continue
+        if element.getparent() is None:
+            # ทั้งเอกสารถูกซ่อน จึงไม่มีตารางที่แสดงผล
+            raise ValueError("ไม่พบตารางในไฟล์ HTML")
+        element.drop_tree()
+
+
+def html_table_rows(html_text):
+    """
+    อ่านแถวจาก table แรกในไฟล์ HTML โดยตรงด้วย lxml (ไม่ต้องสร้าง DataFrame)
+    เซลล์ที่มี colspan/rowspan จะถูกเติมค่าซ้ำ ข้ามเซลล์ที่ถูกซ่อน
+    และแถวที่สั้นกว่าจะถูกเติมเซลล์ว่างให้ครบ เหมือน pandas.read_html
+    Returns: list ของแถว (แต่ละแถวเป็น list ของข้อความในเซลล์)
+    """
+    tree = lxml.html.fromstring(html_text)
+    drop_hidden_elements(tree)
+    tables = tree.xpath('(//table)[1]')
+    if not tables:
+        raise ValueError("ไม่พบตารางในไฟล์ HTML")
+    table = tables[0]
+    
+    # <br> ในเซลล์ให้เป็นช่องว่าง (text_content() จะตัด <br> ทิ้ง ทำให้คำติดกัน)
+    for br in table.xpath('.//br'):
+        br.tail = '\n' + (br.tail or '')
+    
+    rows = []
+    # ค่าที่ยังต้องเติมในแถวถัดไปจาก rowspan: {ตำแหน่งคอลัมน์: [จำนวนแถวที่เหลือ, ข้อความ]}
+    pending = {}
+    # แถวของ <tfoot> อยู่ท้ายตารางเสมอ แม้จะเขียนไว้ก่อน <tbody>
+    for tr in table.xpath('./tr|./thead/tr|./tbody/tr') + table.xpath('./tfoot/tr'):
+        row = []
+        for cell in tr.xpath('./td|./th'):
+            fill_rowspan_cells(row, pending)
+            text = HTML_WHITESPACE_RE.sub(' ', cell.text_content()).strip()
+            rowspan = html_cell_span(cell, 'rowspan')
+            for _ in range(html_cell_span(cell, 'colspan')):
+                if rowspan > 1:
+                    pending[len(row)] = [rowspan - 1, text]
+                row.append(text)
+        fill_rowspan_cells(row, pending)
+        
+        if row:
+            rows.append(row)
+    
+    if not rows:
+        raise ValueError("ไม่พบข้อมูลในตารางของไฟล์ HTML")
+    
+    # เติมเซลล์ว่างให้ทุกแถวมีจำนวนคอลัมน์เท่ากับแถวที่ยาวที่สุด
+    width = max(len(row) for row in rows)
+    for row in rows:
+        row.extend([''] * (width - len(row)))
+    return rows
+
+
+# ค่า float ที่เป็นจำนวนเต็มได้แม่นยำ (ค่าที่ใหญ่กว่านี้เขียนแบบ float เช่น 1e+20)
+EXCEL_MAX_EXACT_INT = 2 ** 53
+
+
+def excel_cell_value(value):
+    """แปลงตัวเลขจำนวนเต็มที่ Excel เก็บเป็น float (เช่น 90.0) ให้เป็น int (เฉพาะค่าที่น้อยกว่า 2**53)"""
+    if isinstance(value, float) and value.is_integer() and abs(value) < EXCEL_MAX_EXACT_INT:
+        return int(value)
+    return value
+
+
+def excel_rows(file_like):
+    """
+    อ่านแถวจาก sheet แรกด้วย python-calamine โดยตรง (ไม่ต้องสร้าง DataFrame)
+    ใช้ from_filelike ให้ calamine เลือก reader จากเนื้อหาไฟล์ (ไม่ใช่นามสกุล)
+    ไฟล์ .xlsx ที่ถูกเปลี่ยนชื่อเป็น .xls จึงยังอ่านได้
+    Returns: iterator ของแถว (แถวแรกคือหัวคอลัมน์)
+    """
+    if hasattr(file_like, 'read'):
+        file_like.seek(0)
+        workbook = CalamineWorkbook.from_filelike(file_like)
+    else:
+        with open(file_like, 'rb') as f:
+            workbook = CalamineWorkbook.from_filelike(f)
+    sheet = workbook.get_sheet_by_index(0)
+    # iter_rows() เริ่มที่คอลัมน์แรกที่มีข้อมูล จึงเติมเซลล์ว่างด้านหน้าให้คอลัมน์อยู่ตำแหน่งเดิม
+    # (sheet ว่างจะมี start เป็น None)
+    leading_cells = [''] * sheet.start[1] if sheet.start else []
+    return (leading_cells + [excel_cell_value(value) for value in row] for row in sheet.iter_rows())
+
+
+def csv_rows(file_like):
+    """
+    อ่านแถวจากไฟล์ตามประเภทไฟล์จริง (ไม่ผ่าน DataFrame)
+    ไฟล์จะถูกเปิดและตรวจสอบทันที จึงพบข้อผิดพลาดก่อนเริ่มเขียน CSV
+    
+    Args:
+        file_like: path ของไฟล์ หรือ file-like object
+    
+    Returns:
+        iterator ของแถว (แถวแรกคือหัวคอลัมน์)
+    """
+    # ตรวจสอบประเภทไฟล์จริงๆ จาก signature แทนการลองอ่านแล้วรอให้ error
+    file_type = sniff_file_type(file_like)
+    if file_type in ('xls', 'xlsx'):
+        # ใช้ calamine ซึ่งเขียนด้วย Rust เร็วกว่า xlrd/openpyxl มาก
+        return excel_rows(file_like)
+    
+    # อ่านเป็น HTML (กรณีที่ไฟล์เป็น HTML ที่บันทึกเป็น .xls)
+    try:
+        html_text = read_html_text(file_like)
+        return html_table_rows(html_text)
+    except Exception as e:
+        raise ValueError(f"ไม่สามารถอ่านไฟล์ได้: {str(e)}")
+
+
+def csv_writer(f):
+    """สร้าง csv.writer สำหรับ CSV UTF-8 (Comma delimited) ที่ใช้ทั้ง command line และเว็บแอป"""
+    return csv.writer(f, lineterminator='\n', quoting=csv.QUOTE_MINIMAL)
+
+
+def convert_to_csv_bytes(file_like):
+    """
+    แปลงไฟล์เป็น CSV UTF-8 พร้อม BOM ในหน่วยความจำ (เว็บแอปใช้ฟังก์ชันนี้รันใน process pool)
+    
+    Args:
+        file_like: path ของไฟล์ หรือ file-like object
+    
+    Returns:
+        bytes ของ CSV (ส่งข้าม process ได้)
+    """
+    rows = csv_rows(file_like)
+    
+    # เขียนลง BytesIO โดยตรง ไม่ต้องสร้าง string ของ CSV ทั้งไฟล์ก่อน
+    output = BytesIO()
+    output.write(b'\xef\xbb\xbf')
+    text_output = TextIOWrapper(output, encoding='utf-8', newline='')
+    writer = csv_writer(text_output)
+    writer.writerows(rows)
+    text_output.flush()
+    text_output.detach()
+    return output.getvalue()
 
 
 def xls_to_csv_utf8(input_file, output_file=None):
@@ -38,52 +276,15 @@ def xls_to_csv_utf8(input_file, output_file=None):
             input_path = Path(input_file)
             output_file = input_path.with_suffix('.csv')
         
-        # ตรวจสอบประเภทไฟล์จริงๆ
-        input_path = Path(input_file)
-        
-        # อ่านไฟล์ Excel โดยใช้ pandas (รองรับทั้ง .xls, .xlsx และ HTML ที่บันทึกเป็น .xls)
-        # pandas จะพยายามอ่านเป็น Excel ก่อน ถ้าไม่ได้จะลองอ่านเป็น HTML
-        try:
-            # ลองอ่านเป็น Excel ก่อน (ให้ pandas ตรวจจับ header อัตโนมัติ)
-            df = pd.read_excel(input_file, sheet_name=0, engine=None, header=0)
-        except Exception:
-            # ถ้าไม่ได้ ลองอ่านเป็น HTML
-            try:
-                # อ่านไฟล์เป็น bytes ก่อน แล้ว decode เป็น UTF-8 เพื่อให้แน่ใจว่า encoding ถูกต้อง
-                with open(input_file, 'rb') as f:
-                    html_content = f.read()
-                
-                # ลอง decode ด้วย UTF-8 ก่อน
-                try:
-                    html_text = html_content.decode('utf-8')
-                except UnicodeDecodeError:
-                    # ถ้า UTF-8 ไม่ได้ ลอง encoding อื่นๆ
-                    encodings = ['cp874', 'tis-620', 'iso-8859-11', 'windows-874']
-                    html_text = None
-                    for enc in encodings:
-                        try:
-                            html_text = html_content.decode(enc)
-                            break
-                        except UnicodeDecodeError:
-                            continue
-                    
-                    if html_text is None:
-                        # ถ้ายังไม่ได้ ให้ใช้ errors='replace' หรือ 'ignore'
-                        html_text = html_content.decode('utf-8', errors='replace')
-                
-                # อ่าน HTML จาก string โดยใช้ StringIO
-                html_io = StringIO(html_text)
-                dfs = pd.read_html(html_io, encoding='utf-8')
-                if dfs:
-                    df = dfs[0]  # ใช้ table แรก
-                else:
-                    raise ValueError("ไม่พบตารางในไฟล์ HTML")
-            except Exception as e:
-                raise ValueError(f"ไม่สามารถอ่านไฟล์ได้: {str(e)}")
+        # อ่านไฟล์ (รองรับทั้ง .xls, .xlsx และ HTML ที่บันทึกเป็น .xls) เป็นแถวโดยตรง ไม่ผ่าน DataFrame
+        # อ่านให้เสร็จก่อนเปิดไฟล์ output เพื่อไม่ให้เหลือไฟล์ว่างถ้าอ่านไม่ได้
+        rows = csv_rows(input_file)
         
         # บันทึกเป็น CSV UTF-8 (Comma delimited) พร้อม BOM เพื่อให้ Excel รู้ว่าเป็น UTF-8
-        # header=True เพื่อเก็บหัวคอลัมน์
-        df.to_csv(output_file, index=False, header=True, encoding='utf-8-sig', sep=',')
+        # แถวแรกคือหัวคอลัมน์
+        with open(output_file, 'w', encoding='utf-8-sig', newline='') as f:
+            writer = csv_writer(f)
+            writer.writerows(rows)
         
         print(f"✓ แปลงไฟล์สำเร็จ: {input_file} → {output_file}")
         return output_file
@@ -122,9 +323,13 @@ def batch_convert(input_directory, output_directory=None):
     
     print(f"พบไฟล์ .xls ทั้งหมด {len(xls_files)} ไฟล์")
     
-    for xls_file in xls_files:
-        output_file = output_path / xls_file.with_suffix('.csv').name
-        xls_to_csv_utf8(str(xls_file), str(output_file))
+    input_files = [str(xls_file) for xls_file in xls_files]
+    output_files = [str(output_path / xls_file.with_suffix('.csv').name) for xls_file in xls_files]
+    
+    # แปลงไฟล์แบบขนานหลาย process (แต่ละไฟล์แยกกันอิสระ)
+    max_workers = min(len(xls_files), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(xls_to_csv_utf8, input_files, output_files))
 
 
 def main():